@@ -46,6 +46,14 @@ moving_obs = [(0.2, 0, 0, 0.6, 0.1),
 #        (0.0, -0.75, 0.02)]               # Define obstacles as list of tuples (x,y,radius)
 
 
+# Solver options
+nlp_compilation = "vm"                     # Options: "vm" (CasADi virtual machine), "jit", "aot" (both require gcc)
+ipopt_linear_solver = "ma57"               # Options: "ma57", "ma27", "pardiso", "mumps" (falls back to "mumps" with a warning if unavailable)
+store_predictions = False                  # Whether to store the predicted trajectories (needed for the prediction plots)
+solve_period = 1                           # Max time steps between MPC solves (1 to solve at every step)
+resolve_tol = 1e-3                         # Re-solve earlier if the state or tvp changed more than this since the last solve
+
+
 scenario = 1                               # Options: 1-6 or None
 
 
@@ -6,6 +6,7 @@ Date: Fall 2022
 
 import numpy as np
 
+import config
 from mpc_cbf import MPC
 from plotter import Plotter
 import util
@@ -21,9 +22,11 @@ def main():
     # Plots
     plotter = Plotter(controller)
     plotter.plot_results()
-    plotter.plot_predictions()
+    if config.store_predictions:
+        plotter.plot_predictions()
     plotter.plot_path()
-    plotter.create_trajectories_animation()
+    if config.store_predictions:
+        plotter.create_trajectories_animation()
     plotter.create_path_animation()
     plotter.plot_cbf()
 
@@ -1,3 +1,8 @@
+import hashlib
+import os
+import subprocess
+import warnings
+
 import do_mpc
 from casadi import *
 
@@ -39,12 +44,22 @@ class MPC:
         self.gamma = config.gamma                # CBF parameter
         self.safety_dist = config.safety_dist    # Safety distance
         self.controller = config.controller      # Type of control
+        self.nlp_compilation = config.nlp_compilation  # How to evaluate the NLP functions
+        self.ipopt_linear_solver = self.get_ipopt_linear_solver(config.ipopt_linear_solver)  # Linear solver used by IPOPT
+        self.store_predictions = config.store_predictions  # Whether to store the predicted trajectories
+        self.solve_period = config.solve_period  # Max time steps between MPC solves
+        self.resolve_tol = config.resolve_tol    # State change that triggers an earlier MPC solve
+
+        x = SX.sym('x', 3)
+        self.B_fun = Function('B', [x], [self.get_sys_matrix_B(x)])  # System input matrix B(x)
 
         self.model = self.define_model()
         self.mpc = self.define_mpc()
         self.simulator = self.define_simulator()
         self.estimator = do_mpc.estimator.StateFeedback(self.model)
+        self.aux_fun = Function('aux', [self.model.x, self.model.u, self.model.tvp], [self.model.aux])
         self.set_init_state()
+        self.init_solver_buffers()
 
     def define_model(self):
         """Configures the dynamical model of the system (and part of the objective function).
@@ -66,7 +81,7 @@ class MPC:
         _u = model.set_variable(var_type='_u', var_name='u', shape=(n_controls, 1))
 
         # State Space matrices
-        B = self.get_sys_matrix_B(_x)
+        B = self.B_fun(_x)
 
         # Set right-hand-side of ODE for all introduced states (_x).
         x_next = _x + B@_u*self.Ts
@@ -98,12 +113,9 @@ class MPC:
         Returns:
           - B(casadi.casadi.SX): The system input matrix B [3x2]
         """
-        a = 1e-9  # Small positive constant so system has relative degree 1
         B = SX.zeros(3, 2)
         B[0, 0] = cos(x[2])
-        B[0, 1] = -a*sin(x[2])
         B[1, 0] = sin(x[2])
-        B[1, 1] = a*cos(x[2])
         B[2, 1] = 1
         return B
 
@@ -126,11 +138,11 @@ class MPC:
             model.set_variable('_tvp', 'y_set_point')
 
             # Define state error
-            theta_des = np.arctan2(model.tvp['y_set_point'] - model.x['x', 1], model.tvp['x_set_point'] - model.x['x', 0])
-            X = SX.zeros(3, 1)
-            X[0] = model.x['x', 0] - model.tvp['x_set_point']
-            X[1] = model.x['x', 1] - model.tvp['y_set_point']
-            X[2] = np.arctan2(sin(theta_des - model.x['x', 2]), cos(theta_des - model.x['x', 2]))
+            dx = model.x['x', 0] - model.tvp['x_set_point']
+            dy = model.x['x', 1] - model.tvp['y_set_point']
+            theta_des = atan2(-dy, -dx)
+            dtheta = theta_des - model.x['x', 2]
+            X = vertcat(dx, dy, atan2(sin(dtheta), cos(dtheta)))
 
         cost_expression = transpose(X)@self.Q@X
         return model, cost_expression
@@ -149,8 +161,8 @@ class MPC:
                      'n_horizon': self.T_horizon,
                      't_step': self.Ts,
                      'state_discretization': 'discrete',
-                     'store_full_solution': True,
-                     # 'nlpsol_opts': {'ipopt.linear_solver': 'MA27'}
+                     'store_full_solution': self.store_predictions,
+                     'nlpsol_opts': self.get_nlpsol_opts()
                      }
         mpc.set_param(**setup_mpc)
 
@@ -179,8 +191,93 @@ class MPC:
                 mpc = self.add_cbf_constraints(mpc)
 
         mpc.setup()
+
+        # Replace the solver with one that loads the precompiled NLP functions
+        if self.nlp_compilation == "aot":
+            mpc.S = self.get_compiled_solver(mpc)
         return mpc
 
+    def get_nlpsol_opts(self):
+        """Defines the options passed to the NLP solver (IPOPT).
+
+        When JIT is enabled, the NLP functions evaluated by IPOPT at every iteration (objective,
+        constraints and their derivatives) are compiled to native code at every setup. Use the AOT
+        compilation to reuse the compiled functions across runs.
+
+        Returns:
+          - nlpsol_opts(dict): The NLP solver options
+        """
+        nlpsol_opts = {'ipopt.print_level': 0,
+                       'ipopt.sb': 'yes',
+                       'print_time': 0,
+                       'expand': True,  # Expand the MX graph to SX for cheaper evaluations
+                       'ipopt.warm_start_init_point': 'yes',  # Warm-start from the previous solution & multipliers
+                       'ipopt.linear_solver': self.ipopt_linear_solver}
+        if self.nlp_compilation == "jit":
+            nlpsol_opts.update({'jit': True,
+                                'compiler': 'shell',
+                                'jit_options': {'compiler': 'gcc', 'flags': ['-O3', '-march=native']}})
+        return nlpsol_opts
+
+    @staticmethod
+    def get_ipopt_linear_solver(linear_solver):
+        """Returns the requested linear solver for IPOPT, or MUMPS (with a warning) if it is not available.
+
+        The HSL solvers (e.g. MA57) and Pardiso are loaded by IPOPT at runtime, so their availability
+        is checked by solving a trivial problem.
+
+        Inputs:
+          - linear_solver(str): The name of the requested linear solver
+        Returns:
+          - linear_solver(str): The name of the linear solver to use
+        """
+        if linear_solver == 'mumps':
+            return 'mumps'
+
+        x = SX.sym('x')
+        solver = nlpsol('solver', 'ipopt', {'x': x, 'f': x**2},
+                        {'ipopt.linear_solver': linear_solver, 'ipopt.print_level': 0, 'ipopt.sb': 'yes',
+                         'print_time': 0, 'error_on_fail': False})
+        solver(x0=1)
+        if solver.stats()['success']:
+            return linear_solver
+        warnings.warn("The IPOPT linear solver '{}' is not available, falling back to 'mumps'.".format(linear_solver))
+        return 'mumps'
+
+    def get_compiled_solver(self, mpc, filename='mpc_nlp'):
+        """Creates an NLP solver whose functions are compiled ahead of time into a shared library.
+
+        The C code of the NLP functions is regenerated at every setup and the library is named after
+        its hash, so that different NLPs (e.g. another controller or gamma) never share a library.
+        It is only compiled with gcc if no library exists for that code yet, which also avoids
+        overwriting a library that is already loaded.
+
+        Inputs:
+          - mpc(do_mpc.controller.MPC): The mpc controller (after setup)
+          - filename(str):              The prefix of the generated C file and shared library
+        Returns:
+          - S(casadi.casadi.Function):  The NLP solver
+        """
+        tmp_name = filename + '_tmp' + str(os.getpid())
+        c_file = tmp_name + '.c'
+        tmp_so_file = './' + tmp_name + '.so'
+        try:
+            mpc.S.generate_dependencies(c_file)
+            with open(c_file) as f:
+                code = f.read().replace(tmp_name, filename)  # The file name is only used as a symbol prefix
+            so_file = './' + filename + '_' + hashlib.sha1(code.encode()).hexdigest() + '.so'
+            if not os.path.exists(so_file):
+                subprocess.run(['gcc', '-O3', '-march=native', '-shared', '-fPIC', c_file, '-o', tmp_so_file],
+                               check=True)
+                os.replace(tmp_so_file, so_file)
+        finally:
+            for tmp_file in (c_file, tmp_so_file):
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+        nlpsol_opts = self.get_nlpsol_opts()
+        del nlpsol_opts['expand']  # External functions cannot be expanded
+        return nlpsol('S', 'ipopt', so_file, nlpsol_opts)
+
     def add_obstacle_constraints(self, mpc):
         """Adds the obstacle constraints to the mpc controller. (MPC-DC)
 
@@ -216,52 +313,79 @@ class MPC:
           - mpc(do_mpc.controller.MPC): The mpc model with CBF constraints added
         """
         cbf_constraints = self.get_cbf_constraints()
-        i = 0
-        for cbc in cbf_constraints:
-            mpc.set_nl_cons('cbf_constraint'+str(i), cbc, ub=0)
-            i += 1
+        mpc.set_nl_cons('cbf_constraint', cbf_constraints, ub=0)
         return mpc
 
     def get_cbf_constraints(self):
         """Computes the CBF constraints for all obstacles.
 
+        The linear velocity enters h(x_{k+1}) directly through the discrete-time dynamics, so the
+        constraint has relative degree 1 in v without perturbing B. The angular velocity only
+        affects h(x_{k+2}) and is accounted for by enforcing the constraint at every horizon step.
+
+        The constraint is defined once for a single obstacle and mapped over all obstacles, so that
+        a single vector constraint is added instead of one scalar constraint per obstacle.
+
         Returns:
-          - cbf_constraints(list): The CBF constraints for each obstacle
+          - cbf_constraints(casadi.casadi.SX): The CBF constraints for each obstacle [n_obs x 1]
         """
-        # Get state vector x_{t+k+1}
-        B = self.get_sys_matrix_B(self.model.x['x'])
-        x_k1 = self.model.x['x'] + B@self.model.u['u']*self.Ts
-
-        # Compute CBF constraints
-        cbf_constraints = []
+        # CBF constraint for a single obstacle (x_obs, y_obs, d2)
+        x = SX.sym('x', 3)
+        u = SX.sym('u', 2)
+        obstacle = SX.sym('obstacle', 3)
+        x_obs, y_obs, d2 = vertsplit(obstacle)
+
+        # Position relative to the obstacle at steps k and k+1 (x_{k+1} = x_k + B*u_k*T_s)
+        dx = x[0] - x_obs
+        dy = x[1] - y_obs
+        dp = self.B_fun(x)@u*self.Ts
+        dx_k1 = dx + dp[0]
+        dy_k1 = dy + dp[1]
+
+        # -h(x_{k+1}) + (1-γ)*h(x_k), with the squared minimum distance terms combined
+        cbf_expr = -(dx_k1*dx_k1 + dy_k1*dy_k1) + (1-self.gamma)*(dx*dx + dy*dy) + self.gamma*d2
+        cbf = Function('cbf', [x, u, obstacle], [cbf_expr])
+
+        # Obstacles stacked as columns
+        obstacles = []
         if self.static_obstacles_on:
-            for obs in self.obs:
-                h_k1 = self.h(x_k1, obs)
-                h_k = self.h(self.model.x['x'], obs)
-                cbf_constraints.append(-h_k1 + (1-self.gamma)*h_k)
+            for x_obs, y_obs, r_obs in self.obs:
+                obstacles.append(vertcat(x_obs, y_obs, self.get_min_dist_squared(r_obs)))
 
         if self.moving_obstacles_on:
             for i in range(len(self.moving_obs)):
-                obs = (self.model.tvp['x_moving_obs'+str(i)], self.model.tvp['y_moving_obs'+str(i)], self.moving_obs[i][4])
-                h_k1 = self.h(x_k1, obs)
-                h_k = self.h(self.model.x['x'], obs)
-                cbf_constraints.append(-h_k1 + (1-self.gamma)*h_k)
+                obstacles.append(vertcat(self.model.tvp['x_moving_obs'+str(i)], self.model.tvp['y_moving_obs'+str(i)],
+                                         self.get_min_dist_squared(self.moving_obs[i][4])))
 
-        return cbf_constraints
+        obstacles = horzcat(*obstacles)
+        cbf_constraints = cbf.map(obstacles.shape[1], 'unroll')(self.model.x['x'], self.model.u['u'], obstacles)
+        return transpose(cbf_constraints)
 
     def h(self, x, obstacle):
         """Computes the Control Barrier Function.
         
         Inputs:
           - x(casadi.casadi.SX): The state vector [3x1]
-          - obstacle(tuple):     The obstacle position and radius
+          - obstacle(tuple):     The obstacle position and squared minimum distance (x_obs, y_obs, d2)
         Returns:
           - h(casadi.casadi.SX): The Control Barrier Function
         """
-        x_obs, y_obs, r_obs = obstacle
-        h = (x[0] - x_obs)**2 + (x[1] - y_obs)**2 - (self.r + r_obs + self.safety_dist)**2
+        x_obs, y_obs, d2 = obstacle
+        dx = x[0] - x_obs
+        dy = x[1] - y_obs
+        h = dx*dx + dy*dy - d2
         return h
 
+    def get_min_dist_squared(self, r_obs):
+        """Computes the squared minimum allowed distance between the robot and an obstacle's center.
+
+        Inputs:
+          - r_obs(float): The obstacle radius
+        Returns:
+          - d2(float):    The squared minimum distance
+        """
+        return float((self.r + r_obs + self.safety_dist)**2)
+
     def set_tvp_for_mpc(self, mpc):
         """Sets the trajectory for trajectory tracking and/or the moving obstacles' trajectory.
 
@@ -272,21 +396,19 @@ class MPC:
         """
         tvp_struct_mpc = mpc.get_tvp_template()
 
+        if self.control_type == "traj_tracking":
+            # Trajectory to follow, precomputed at every time step of the simulation
+            x_traj, y_traj = self.get_reference_position(np.arange(self.sim_time))
+
         def tvp_fun_mpc(t_now):
             if self.control_type == "traj_tracking":
-                # Trajectory to follow
-                if config.trajectory == "circular":
-                    x_traj = config.A*cos(config.w*t_now)
-                    y_traj = config.A*sin(config.w*t_now)
-                elif config.trajectory == "infinity":
-                    x_traj = config.A*cos(config.w*t_now)/(sin(config.w*t_now)**2 + 1)
-                    y_traj = config.A*sin(config.w*t_now)*cos(config.w*t_now)/(sin(config.w*t_now)**2 + 1)
-                else:
-                    print("Select one of the available options for trajectory.")
-                    exit()
-
-                tvp_struct_mpc['_tvp', :, 'x_set_point'] = x_traj
-                tvp_struct_mpc['_tvp', :, 'y_set_point'] = y_traj
+                k = int(round(np.ravel(t_now)[0]/self.Ts))  # Time step index
+                if k < len(x_traj):
+                    x_ref, y_ref = x_traj[k], y_traj[k]
+                else:  # The simulation continues past the precomputed trajectory
+                    x_ref, y_ref = self.get_reference_position(k)
+                tvp_struct_mpc['_tvp', :, 'x_set_point'] = x_ref
+                tvp_struct_mpc['_tvp', :, 'y_set_point'] = y_ref
 
             if self.moving_obstacles_on is True:
                 # Moving obstacles trajectory
@@ -299,6 +421,29 @@ class MPC:
         mpc.set_tvp_fun(tvp_fun_mpc)
         return mpc
 
+    def get_reference_position(self, k):
+        """Computes the position of the reference trajectory for trajectory tracking.
+
+        Inputs:
+          - k(int or numpy.ndarray):       The time step index(es)
+        Returns:
+          - x_ref(float or numpy.ndarray): The x position(s) of the reference trajectory
+          - y_ref(float or numpy.ndarray): The y position(s) of the reference trajectory
+        """
+        wt = config.w*self.Ts*k
+        c = np.cos(wt)
+        s = np.sin(wt)
+        if config.trajectory == "circular":
+            x_ref = config.A*c
+            y_ref = config.A*s
+        elif config.trajectory == "infinity":
+            x_ref = config.A*c/(s**2 + 1)
+            y_ref = config.A*s*c/(s**2 + 1)
+        else:
+            print("Select one of the available options for trajectory.")
+            exit()
+        return x_ref, y_ref
+
     def define_simulator(self):
         """Configures the simulator.
 
@@ -327,11 +472,124 @@ class MPC:
         self.estimator.x0 = self.x0
         self.mpc.set_initial_guess()
 
+    def init_solver_buffers(self):
+        """Allocates the NLP solver inputs once, so that they are updated in place at every MPC step."""
+        # Indices of the parameters and the first control input in the flat NLP vectors
+        self._x0_ind = self.mpc.opt_p.f['_x0']
+        self._u_prev_ind = self.mpc.opt_p.f['_u_prev']
+        self._tvp_ind = self.mpc.opt_p.f['_tvp']
+        self._u0_ind = self.mpc.opt_x.f['_u', 0, 0]
+        self._resolve_ind = self._x0_ind + self._tvp_ind  # Parameters whose change triggers a new solve
+        self._u_scaling = self.mpc._u_scaling.cat.full()
+
+        # Solver inputs (initial guess, parameters, multipliers and bounds)
+        self._x_buf = self.mpc.opt_x_num.cat.full()
+        self._p_buf = self.mpc.opt_p_num.cat.full()
+        self._lam_x_buf = np.zeros(self._x_buf.shape)
+        self._lam_g_buf = np.zeros(self.mpc.nlp_cons_lb.shape)
+        self._bounds = [self.mpc._lb_opt_x.cat.full(), self.mpc._ub_opt_x.cat.full(),
+                        self.mpc.nlp_cons_lb.full(), self.mpc.nlp_cons_ub.full()]
+
     def run_simulation(self):
-        """Runs a closed-loop control simulation."""
+        """Runs a closed-loop control simulation.
+
+        The MPC is solved every solve_period steps, or earlier if the state or the time-varying
+        parameters (e.g. the moving obstacles) have changed more than resolve_tol since the last
+        solve. Otherwise (e.g. once the robot has settled) the previous control input is applied again.
+        """
         x0 = self.x0
+        p_solved = None
         for k in range(self.sim_time):
-            u0 = self.mpc.make_step(x0)
+            t0 = self.mpc.t0
+            tvp = self.mpc.tvp_fun(t0)
+            self._p_buf[self._x0_ind, 0] = np.ravel(x0)
+            self._p_buf[self._tvp_ind, 0] = tvp.cat.full().ravel()
+            p = self._p_buf[self._resolve_ind, 0]
+            if k % self.solve_period == 0 or np.linalg.norm(p - p_solved) > self.resolve_tol:
+                u0 = self.solve_step()
+                aux0 = self.mpc.opt_aux_num['_aux', 0, 0]
+                p_solved = p
+            else:
+                aux0 = self.hold_step(x0, u0, tvp['_tvp', 0])
+            self.record_step(x0, u0, t0, tvp['_tvp', 0], aux0)
             y_next = self.simulator.make_step(u0)
             # y_next = self.simulator.make_step(u0, w0=10**(-4)*np.random.randn(3, 1))  # Optional Additive process noise
-            x0 = self.estimator.make_step(y_next)
+            if isinstance(self.estimator, do_mpc.estimator.StateFeedback):
+                x0 = y_next  # State feedback: the measurement is the state
+            else:
+                x0 = self.estimator.make_step(y_next)
+
+    def solve_step(self):
+        """Solves the MPC problem for the current parameters (equivalent to do_mpc's MPC.solve).
+
+        The solver is called directly with the preallocated inputs, warm-started with the previous
+        solution and multipliers. The solution is written back to the MPC as in MPC.solve.
+
+        Returns:
+          - u0(numpy.ndarray): The control input to apply [2x1]
+        """
+        x, _, g, lam_x, lam_g, _ = self.mpc.S(self._x_buf, self._p_buf, *self._bounds, self._lam_x_buf, self._lam_g_buf)
+        self._x_buf[:] = x
+        self._lam_x_buf[:] = lam_x
+        self._lam_g_buf[:] = lam_g
+
+        self.mpc.opt_p_num.master = DM(self._p_buf)
+        self.mpc.opt_x_num.master = x
+        self.mpc.opt_x_num_unscaled.master = x*self.mpc.opt_x_scaling
+        self.mpc.opt_g_num = g
+        self.mpc.lam_x_num = lam_x
+        self.mpc.lam_g_num = lam_g
+        self.mpc.solver_stats = self.mpc.S.stats()
+        self.mpc.opt_aux_num.master = self.mpc.opt_aux_expression_fun(x, self._p_buf)
+        self.mpc.flags['initial_run'] = True
+        self.record_solver_stats(self.mpc.solver_stats)
+        return self._x_buf[self._u0_ind]*self._u_scaling
+
+    def hold_step(self, x0, u0, tvp0):
+        """Keeps the previous solution without solving the MPC.
+
+        The solver stats of the previous solve are stored again (with zero solve time), so that
+        the stored stats stay aligned with the states and inputs.
+
+        Inputs:
+          - x0(numpy.ndarray):       The current state [3x1]
+          - u0(numpy.ndarray):       The applied control input [2x1]
+          - tvp0(casadi.casadi.DM):  The current time-varying parameters
+        Returns:
+          - aux0(casadi.casadi.DM):  The auxiliary expressions for the current state and input
+        """
+        solver_stats = {stat: 0.0 if stat.startswith(('t_proc', 't_wall')) else value
+                        for stat, value in self.mpc.solver_stats.items()}
+        self.record_solver_stats(solver_stats)
+        return self.aux_fun(x0, u0, tvp0)
+
+    def record_solver_stats(self, solver_stats):
+        """Stores the solver stats selected in the MPC settings.
+
+        Inputs:
+          - solver_stats(dict): The solver stats of the MPC step
+        """
+        self.mpc.data.update(**{stat: value for stat, value in solver_stats.items()
+                                if stat in self.mpc.settings.store_solver_stats})
+
+    def record_step(self, x0, u0, t0, tvp0, aux0):
+        """Stores the results of an MPC step and advances the MPC time (as in do_mpc's MPC.make_step).
+
+        Inputs:
+          - x0(numpy.ndarray):       The current state [3x1]
+          - u0(numpy.ndarray):       The applied control input [2x1]
+          - t0(numpy.ndarray):       The current time
+          - tvp0(casadi.casadi.DM):  The current time-varying parameters
+          - aux0(casadi.casadi.DM):  The auxiliary expressions for the current state and input
+        """
+        self.mpc.data.update(_x=x0, _u=u0, _z=np.zeros(0), _tvp=tvp0, _p=np.zeros(0), _time=t0, _aux=aux0,
+                             opt_p_num=self._p_buf)
+        if self.mpc.settings.store_full_solution:
+            self.mpc.data.update(_opt_x_num=self.mpc.opt_x_num_unscaled, _opt_aux_num=self.mpc.opt_aux_num)
+        if self.mpc.settings.store_lagr_multiplier:
+            self.mpc.data.update(_lam_g_num=self.mpc.lam_g_num)
+
+        self.mpc.t0 = t0 + self.Ts
+        self.mpc._x0.master = DM(x0)
+        self.mpc._u0.master = DM(u0)
+        self._p_buf[self._u_prev_ind] = u0
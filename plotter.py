@@ -151,10 +151,11 @@ class Plotter:
         if self.controller.static_obstacles_on or self.controller.moving_obstacles_on:
             cbfs = []
             if self.controller.static_obstacles_on:
-                for i in range(len(self.controller.obs)):
+                for x_obs, y_obs, r_obs in self.controller.obs:
+                    obs = (x_obs, y_obs, self.controller.get_min_dist_squared(r_obs))
                     h = []
                     for x in self.mpc.data['_x']:
-                        h.append(self.controller.h(x, self.controller.obs[i]))
+                        h.append(self.controller.h(x, obs))
                     cbfs.append(h)
 
             cbfs_mov = []
@@ -162,7 +163,8 @@ class Plotter:
                 for i in range(len(self.controller.moving_obs)):
                     h = []
                     for x in self.mpc.data['_x']:
-                        obs = (self.mpc.data['_tvp', 'x_moving_obs'+str(i)][i], self.mpc.data['_tvp', 'y_moving_obs'+str(i)][i], self.controller.moving_obs[i][4])
+                        obs = (self.mpc.data['_tvp', 'x_moving_obs'+str(i)][i], self.mpc.data['_tvp', 'y_moving_obs'+str(i)][i],
+                               self.controller.get_min_dist_squared(self.controller.moving_obs[i][4]))
                         h.append(self.controller.h(x, obs))
                     cbfs_mov.append(h)
 
@@ -6,4 +6,5 @@ if __name__ == '__main__':
     util.compare_results_by_gamma()                   # Compares the path for each method and gamma value
 
     # util.run_multiple_experiments(N=50)               # Runs N experiments for each method
-    # util.compare_controller_results(N=50, gamma=0.1)  # Compares total costs and min distances for each method
\ No newline at end of file
+    # util.compare_controller_results(N=50, gamma=0.1)  # Compares total costs and min distances for each method
+    # util.compare_with_make_step(n_steps=5)            # Checks the MPC data against do_mpc's make_step
\ No newline at end of file
@@ -1,4 +1,6 @@
+from casadi import DM
 from do_mpc.data import save_results, load_results
+import numpy as np
 
 import config
 from mpc_cbf import MPC
@@ -120,3 +122,35 @@ def compare_results_by_gamma():
 
     # Plot path comparison
     plot_path_comparisons(results, gammas)
+
+
+def compare_with_make_step(n_steps=5):
+    """Checks that MPC.run_simulation stores the same MPC data and state as do_mpc's MPC.make_step."""
+
+    # Closed-loop simulation with the direct solver calls
+    controller = MPC()
+    controller.sim_time = n_steps
+    controller.run_simulation()
+
+    # Closed-loop simulation with do_mpc's make_step
+    reference = MPC()
+    x0 = reference.x0
+    for k in range(n_steps):
+        u0 = reference.mpc.make_step(x0)
+        x0 = reference.simulator.make_step(u0)
+
+    # Compare the stored data (except for the solve times) and the MPC state
+    for field in controller.mpc.data.data_fields:
+        if field.startswith(('t_proc', 't_wall')):
+            continue
+        value, value_ref = controller.mpc.data[field], reference.mpc.data[field]
+        assert value.shape == value_ref.shape and np.allclose(value, value_ref, rtol=1e-6, atol=1e-8), \
+            "The MPC data field {} differs from make_step".format(field)
+    for attr in ['opt_x_num', 'opt_x_num_unscaled', 'lam_x_num', 'lam_g_num', '_x0', '_u0', 't0']:
+        value, value_ref = getattr(controller.mpc, attr), getattr(reference.mpc, attr)
+        if hasattr(value, 'cat'):
+            value, value_ref = value.cat, value_ref.cat
+        value, value_ref = DM(value).full(), DM(value_ref).full()
+        assert value.shape == value_ref.shape and np.allclose(value, value_ref, rtol=1e-6, atol=1e-8), \
+            "The MPC attribute {} differs from make_step".format(attr)
+    print("MPC data and state match make_step over {} steps.".format(n_steps))